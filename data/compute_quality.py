@@ -5,6 +5,9 @@ import libquality.ffmpeg as ffmpeg
 import libquality.quality as quality
 import libquality.reference as reference
 import libquality.profile as profile
+import libquality.report as report
+import libquality.service as service
+import libquality.supervisor as supervisor
 
 
 def main():
@@ -21,11 +24,13 @@ def main():
         "refdir": path.join(basedir, "references"),
         "tmpdir": path.join(basedir, "tmp"),
         "plotdir": path.join(basedir, "plots"),
+        "benchdir": path.join(basedir, "benchmarks"),
+        "reportdir": path.join(basedir, "report"),
     }
 
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "-t", "--task", choices=["all", "transcode", "plot"],
+        "-t", "--task", choices=["all", "transcode", "plot", "report", "benchmark", "serve"],
         help="do only some of the tasks", default="all")
     parser.add_argument(
         "-p", "--profile", nargs="*", choices=profilenames,
@@ -34,9 +39,50 @@ def main():
         "-s", "--source", default=path.join(basedir, "sources.json"),
         help="source description file")
     parser.add_argument(
-        "tag", help="tag to identify your current testing platform")
+        "--trials", type=int, default=5,
+        help="number of measured encodes per format in benchmark task")
+    parser.add_argument(
+        "--warmup", type=int, default=1,
+        help="number of unmeasured encodes per format in benchmark task")
+    parser.add_argument(
+        "--score", action="store_true",
+        help="also compute rate and scores in benchmark task instead of encoding to null")
+    parser.add_argument(
+        "--batch", action="store_true",
+        help="encode and score all references concatenated at once per format")
+    parser.add_argument(
+        "--min-speed", type=float,
+        help="slowest expected encoding speed, jobs exceeding the derived deadline are killed")
+    parser.add_argument(
+        "--stall-timeout", type=float,
+        help="seconds without ffmpeg progress after which a job is killed")
+    parser.add_argument(
+        "--retries", type=int, help="number of retries for hung or crashed jobs")
+    parser.add_argument(
+        "--quarantine", type=int,
+        help="number of failures after which a format is skipped")
+    parser.add_argument(
+        "--listen", default="localhost:8000",
+        help="address to serve scoring requests on in serve task, host:port or unix:/path")
+    parser.add_argument(
+        "--workers", type=int, help="number of concurrent scoring passes in serve task")
+    parser.add_argument(
+        "tag", nargs="?",
+        help="tag to identify your current testing platform, required for encoding tasks")
 
     args = parser.parse_args()
+    if args.tag is None and args.task in ["all", "transcode", "benchmark"]:
+        parser.error(f"task {args.task} requires a tag")
+    if args.batch and args.task == "benchmark":
+        parser.error("--batch is not supported for the benchmark task")
+    if args.trials < 1:
+        parser.error("--trials must be at least 1")
+    if args.warmup < 0:
+        parser.error("--warmup must not be negative")
+
+    supervisor.configure(
+        min_speed=args.min_speed, stall=args.stall_timeout,
+        retries=args.retries, quarantine=args.quarantine)
 
     print("Comparison Profiles:", args.profile)
 
@@ -52,11 +98,31 @@ def main():
         print("Reference videos:", references)
 
         # compute scores
-        quality.compare(references, profs, args.tag, env)
+        quality.compare(references, profs, args.tag, env, batch=args.batch)
+
+    # benchmark measures encoding speed over repeated trials
+    if args.task == "benchmark":
+        references = reference.ensure_references(args.source, env)
+        print("Reference videos:", references)
+
+        benchmark = {"trials": args.trials, "warmup": args.warmup, "score": args.score}
+        quality.compare(references, profs, args.tag, env, benchmark)
+
+    # serve scoring requests with references kept decoded
+    if args.task == "serve":
+        references = reference.ensure_references(args.source, env)
+        print("Reference videos:", references)
+
+        scorer = service.Scorer(references, path.join(env["tmpdir"], "service"), args.workers)
+        service.serve(args.listen, scorer)
 
     # do plots
     if args.task == "all" or args.task == "plot":
         quality.plot(profs, env)
 
+    # generate html report
+    if args.task == "all" or args.task == "report":
+        report.generate(profs, env)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,337 @@
+import asyncio
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import time
+from os import path, makedirs
+import libquality.ffmpeg as ffmpeg
+import libquality.supervisor as supervisor
+from libquality.reference import scale_cmd, variant_path, variant_fresh
+
+
+async def run_process(cmd, deadline=None, stall=None, progress=None, capture=False):
+    """
+    Runs a command as asyncio subprocess, kills it if it exceeds its
+    deadline, if its progress file doesn't change for stall seconds or if
+    the calling task is cancelled.
+
+    Returns: output of the command if capture is set
+    """
+    start = time.monotonic()
+    if capture:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE)
+        waiter = asyncio.ensure_future(proc.communicate())
+    else:
+        proc = await asyncio.create_subprocess_exec(*cmd)
+        waiter = asyncio.ensure_future(proc.wait())
+
+    last = supervisor.activity(progress) if progress else None
+    last_change = start
+
+    try:
+        while True:
+            done, _ = await asyncio.wait({waiter}, timeout=supervisor.POLL_INTERVAL)
+            if done:
+                break
+
+            now = time.monotonic()
+            if progress and stall is not None:
+                current = supervisor.activity(progress)
+                if current != last:
+                    last = current
+                    last_change = now
+
+            if deadline is not None and now - start > deadline:
+                raise supervisor.JobTimeout(
+                    f"Killed '{cmd[0]}' after deadline of {deadline:0.0f}s")
+
+            if progress and stall is not None and now - last_change > stall:
+                raise supervisor.JobStalled(
+                    f"Killed '{cmd[0]}' after {stall:0.0f}s without progress")
+
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        await asyncio.gather(waiter, return_exceptions=True)
+        raise
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    if capture:
+        return waiter.result()[0]
+
+
+async def run_job(cmd, deadline=None, stall=None, progress=None, capture=False,
+                  retries=None):
+    """
+    Runs a command as asyncio subprocess under supervision, retrying it with
+    exponential backoff if it hangs or crashes, see supervisor.run
+    """
+    if retries is None:
+        retries = supervisor.settings["retries"]
+
+    attempt = 0
+    while True:
+        try:
+            return await run_process(cmd, deadline, stall, progress, capture)
+        except subprocess.SubprocessError as err:
+            delay = supervisor.retry_delay(err, attempt, retries)
+            if delay is None:
+                raise
+
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+class Runner:
+    """
+    Encodes and scores formats with a limited number of concurrent
+    subprocesses, probes included. Raw references and scaled variants are
+    decoded once on first use.
+    """
+
+    def __init__(self, tmpdir, concurrency):
+        self.tmpdir = tmpdir
+        self.limit = asyncio.Semaphore(concurrency)
+        self.sources = {}
+        self.durations = {}
+        makedirs(tmpdir, exist_ok=True)
+
+    async def probe(self, media, entries="-show_format -show_streams"):
+        """Probes a media file, see ffmpeg.ffprobe"""
+        cmd = ffmpeg.ffprobe_cmd(media, entries)
+        try:
+            async with self.limit:
+                output = await run_job(shlex.split(cmd), supervisor.settings["timeout"],
+                                       capture=True)
+            return json.loads(output.decode("utf-8"))
+        except (subprocess.SubprocessError, ValueError):
+            return None
+
+    async def duration(self, media):
+        """Returns duration of a reference or variant, probing it on first use"""
+        if media not in self.durations:
+            self.durations[media] = ffmpeg.parse_duration(await self.probe(media))
+
+        return self.durations[media]
+
+    async def supervise(self, cmd, media, progress):
+        duration = await self.duration(media)
+        async with self.limit:
+            await run_job(shlex.split(cmd), supervisor.deadline_for(duration),
+                          supervisor.settings["stall"], progress)
+
+    async def scale(self, reference, scale):
+        """
+        Returns path of the scaled variant of a reference, scaling it if it
+        is missing or stale, see reference.ensure_variants
+        """
+        variant = variant_path(reference, scale)
+        if variant_fresh(reference, variant):
+            return variant
+
+        tmpvariant = f"{path.splitext(variant)[0]}.tmp.nut"
+        progresspath = f"{tmpvariant}.progress"
+        print(f"Scaling reference {reference} to {scale}")
+        try:
+            async with self.limit:
+                await run_job(shlex.split(scale_cmd(reference, tmpvariant, scale, progresspath)),
+                              stall=supervisor.settings["stall"], progress=progresspath)
+        except subprocess.SubprocessError as err:
+            raise ffmpeg.DecodeFailed(f"Failed to scale '{reference}' to {scale} - {err}")
+        finally:
+            try:
+                os.remove(progresspath)
+            except FileNotFoundError:
+                pass
+
+        os.rename(tmpvariant, variant)
+        return variant
+
+    async def decode(self, reference, scale):
+        src = reference
+        if scale is not None:
+            src = await self.scale(reference, scale)
+
+        refname = path.basename(path.splitext(reference)[0])
+        rawref = path.join(self.tmpdir, f"{refname}_{scale or 'ref'}.nut")
+        progresspath = f"{rawref}.progress"
+        try:
+            await self.supervise(ffmpeg.decode_cmd(src, rawref, progresspath), src,
+                                 progresspath)
+        except subprocess.SubprocessError as err:
+            raise ffmpeg.DecodeFailed(f"Failed to decode '{src}' - {err}")
+
+        return rawref
+
+    async def source(self, reference, scale=None):
+        """Returns path of the raw reference, decoding it on first use"""
+        key = (reference, scale)
+        if key not in self.sources:
+            self.sources[key] = asyncio.ensure_future(self.decode(reference, scale))
+
+        # shield the shared decode from cancellation of a single waiting job
+        return await asyncio.shield(self.sources[key])
+
+    async def transcode(self, reference, opts, scale, name):
+        """
+        Transcodes reference to a specific format and computes the vmaf
+        score of the resulting file, see ffmpeg.transcode
+        """
+        rawref = await self.source(reference)
+        src = rawref
+        if scale is not None:
+            src = await self.source(reference, scale)
+
+        result = {}
+        codedpath = path.join(self.tmpdir, f"{name}.nut")
+        progresspath = path.join(self.tmpdir, f"{name}.progress")
+        scorepath = path.join(self.tmpdir, f"{name}.json")
+
+        print(f"Transcoding: {name}")
+        try:
+            await self.supervise(ffmpeg.encode_cmd(src, opts, codedpath, progresspath), src,
+                                 progresspath)
+        except subprocess.SubprocessError as err:
+            raise ffmpeg.EncodeFailed(f"Failed at format {name} - {err}")
+
+        speed = ffmpeg.read_speed(progresspath)
+        if speed is not None:
+            result["speed"] = speed
+
+        probe = await self.probe(codedpath, ffmpeg.PACKET_ENTRIES)
+        result["rate"] = ffmpeg.parse_rate(probe)
+
+        cmd = ffmpeg.score_cmd(rawref, codedpath, scorepath, progresspath, scale)
+        try:
+            await self.supervise(cmd, rawref, progresspath)
+        except subprocess.SubprocessError as err:
+            raise ffmpeg.ScoreFailed(f"Failed to compute score for {name} - {err}")
+
+        frames = ffmpeg.read_frame_scores(scorepath)
+        result.update(ffmpeg.aggregate_scores([score for _, score in frames]))
+
+        sizes = ffmpeg.parse_packet_sizes(probe)
+        duration = await self.duration(rawref)
+        result["frames"] = ffmpeg.frame_data(frames, sizes or [], duration)
+
+        return result
+
+    async def close(self):
+        for task in self.sources.values():
+            task.cancel()
+
+        await asyncio.gather(*self.sources.values(), return_exceptions=True)
+
+
+async def run(profiles, references, tag, tmpdir, concurrency=None):
+    """
+    Encodes and scores all formats of all profiles for all references and
+    yields annotated results as soon as they are ready.
+
+    Formats are expanded lazily, only a bounded number of jobs is in flight
+    at a time. Formats shared between profiles are encoded and scored only
+    once per reference. Closing the generator or cancelling the consuming
+    task kills all running subprocesses.
+
+    | Arguments:
+    | profiles: list of profile instances
+    | references: list of prepared reference files
+    | tag: tag to identify the current testing platform
+    | tmpdir: directory to store temporary files in
+    | concurrency: maximum number of concurrent subprocesses, defaults to
+    |   the number of cpus
+
+    Usage:
+    | async for result in run(profiles, references, "skylake", "tmp"):
+    |     print(result["score_mean"])
+    """
+    concurrency = concurrency or os.cpu_count() or 1
+    runner = Runner(tmpdir, concurrency)
+
+    def jobs():
+        for reference in references:
+            for profile in profiles:
+                for fmt in profile.iter_formats():
+                    yield reference, profile, fmt
+
+    pending = jobs()
+    exhausted = False
+
+    tasks = {}
+    listeners = {}
+    finished = {}
+    failures = {}
+
+    try:
+        while True:
+            ready = []
+
+            # keep a bounded number of jobs in flight
+            while not exhausted and len(tasks) < 2 * concurrency:
+                job = next(pending, None)
+                if job is None:
+                    exhausted = True
+                    break
+
+                reference, profile, fmt = job
+                fmtkey = profile.format_key(fmt)
+                key = (reference, fmtkey)
+
+                if key in finished:
+                    ready.append((finished[key], reference, profile, fmt))
+                elif key in listeners:
+                    listeners[key].append((profile, fmt))
+                elif failures.get(fmtkey, 0) >= supervisor.settings["quarantine"]:
+                    print(f"Skipping quarantined format {fmt['opts']}")
+                else:
+                    refname = path.basename(path.splitext(reference)[0])
+                    name = f"{refname}_{hashlib.sha1(repr(fmtkey).encode()).hexdigest()[:16]}"
+                    task = asyncio.ensure_future(
+                        runner.transcode(reference, fmt["opts"], fmtkey[1], name))
+                    tasks[task] = key
+                    listeners[key] = [(profile, fmt)]
+
+            for result, reference, profile, fmt in ready:
+                if result is None:
+                    continue
+
+                refname = path.basename(path.splitext(reference)[0])
+                yield profile.annotate_result(result, fmt, refname, tag)
+
+            if not tasks:
+                return
+
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                key = tasks.pop(task)
+                reference, fmtkey = key
+                refname = path.basename(path.splitext(reference)[0])
+
+                # failed formats are remembered as None
+                result = None
+                try:
+                    result = task.result()
+                except (ffmpeg.EncodeFailed, ffmpeg.ScoreFailed) as err:
+                    print(err)
+                    failures[fmtkey] = failures.get(fmtkey, 0) + 1
+                except ffmpeg.DecodeFailed as err:
+                    print(err)
+
+                finished[key] = result
+                for profile, fmt in listeners.pop(key):
+                    if result is None:
+                        continue
+
+                    yield profile.annotate_result(result, fmt, refname, tag)
+
+    finally:
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await runner.close()
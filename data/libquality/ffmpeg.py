@@ -3,26 +3,37 @@ import shlex
 import re
 import json
 import math
+import statistics
 from os import path
+import libquality.supervisor as supervisor
 
 
-def ffprobe(path):
-    cmd = f"""
-ffprobe -hide_banner -show_format -show_streams
+# packet sizes and bitrate of a coded file in a single probe
+PACKET_ENTRIES = "-select_streams v:0 -show_entries format=bit_rate:packet=pts,size"
+
+
+def ffprobe_cmd(path, entries="-show_format -show_streams"):
+    return f"""
+ffprobe -hide_banner {entries}
     -loglevel quiet -print_format json
     {path}
 """
+
+
+def ffprobe(path, entries="-show_format -show_streams"):
+    cmd = ffprobe_cmd(path, entries)
     try:
-        output = subprocess.check_output(shlex.split(cmd))
-        result = json.loads(output.decode("utf-8"))
-    except (subprocess.CalledProcessError,):
+        job = supervisor.run(shlex.split(cmd), deadline=supervisor.settings["timeout"],
+                             capture=True)
+        result = json.loads(job["output"].decode("utf-8"))
+    except (subprocess.SubprocessError, ValueError):
         return None
 
     return result
 
 
-def probe_rate(path):
-    result = ffprobe(path)
+def parse_rate(result):
+    """Returns bitrate in kbit/s of a probe result"""
     if result is None:
         return None
 
@@ -30,6 +41,54 @@ def probe_rate(path):
     return bitrate
 
 
+def parse_duration(result):
+    """Returns duration in seconds of a probe result"""
+    if result is None:
+        return None
+
+    return float(result["format"]["duration"])
+
+
+def parse_packet_sizes(result):
+    """Returns packet sizes of a probe with PACKET_ENTRIES in presentation order"""
+    if result is None:
+        return None
+
+    packets = sorted(result.get("packets", []), key=lambda packet: int(packet["pts"]))
+    return [int(packet["size"]) for packet in packets]
+
+
+def probe_rate(path):
+    return parse_rate(ffprobe(path))
+
+
+def probe_duration(path):
+    return parse_duration(ffprobe(path))
+
+
+def probe_frames(path):
+    entries = "-select_streams v:0 -count_packets -show_entries stream=nb_read_packets"
+    result = ffprobe(path, entries)
+    if result is None or not result.get("streams"):
+        return None
+
+    return int(result["streams"][0]["nb_read_packets"])
+
+
+def probe_packet_sizes(path):
+    """Returns sizes of all video packets in bytes in presentation order"""
+    return parse_packet_sizes(ffprobe(path, PACKET_ENTRIES))
+
+
+def supervise(cmd, duration, progress):
+    """
+    Runs an ffmpeg command with stall detection and a deadline derived from
+    the duration in seconds of the processed media
+    """
+    return supervisor.run(shlex.split(cmd), deadline=supervisor.deadline_for(duration),
+                          stall=supervisor.settings["stall"], progress=progress)
+
+
 class EncodeFailed(Exception):
     pass
 
@@ -42,92 +101,180 @@ class ScoreFailed(Exception):
     pass
 
 
-def decode(src, dst):
-    """Decodes media file at src and stores it at dst"""
-    cmd = f"""
-ffmpeg -y -hide_banner -nostats -v warning
+def decode_cmd(src, dst, progresspath):
+    return f"""
+ffmpeg -y -hide_banner -nostats -v warning -progress {progresspath}
     -i {src}
     -c:v rawvideo -an
     {dst}
 """
+
+
+def decode(src, dst):
+    """
+    Decodes media file at src and stores it at dst
+
+    Returns: duration in seconds of the media, None if unknown
+    """
+    duration = probe_duration(src)
+    progresspath = f"{dst}.progress"
+    cmd = decode_cmd(src, dst, progresspath)
     try:
-        subprocess.check_call(shlex.split(cmd))
-    except subprocess.CalledProcessError as err:
+        supervise(cmd, duration, progresspath)
+    except subprocess.SubprocessError as err:
         raise DecodeFailed(f"Failed to decode '{src}' - {err}")
 
+    return duration
 
-def calc_score(reference, coded, scale=None):
-    """Computes vmaf scores for encoded video content"""
-    scorepath = f"{coded}.json"
 
-    # scale_filter = "scale=w=0:h=0"
-    # if scale is not None:
-    #     scale_filter = f"scale={scale}:flags=bicubic"
+def decode_concat(srcs, dst):
+    """
+    Decodes media files at srcs and stores them concatenated at dst
 
-    rate = f"""
-ffmpeg -y -hide_banner -v warning
+    Returns: list of ranges with first and last + 1 frame and the duration in
+      seconds of each source in dst
+    """
+    ranges = []
+    start = 0
+    listpath = f"{dst}.txt"
+    with open(listpath, "w") as f:
+        for src in srcs:
+            frames = probe_frames(src)
+            duration = probe_duration(src)
+            if frames is None or duration is None:
+                raise DecodeFailed(f"Failed to probe '{src}'")
+
+            ranges.append({"start": start, "end": start + frames, "duration": duration})
+            start += frames
+            f.write(f"file '{path.abspath(src)}'\n")
+
+    progresspath = f"{dst}.progress"
+    cmd = f"""
+ffmpeg -y -hide_banner -nostats -v warning -progress {progresspath}
+    -f concat -safe 0 -i {listpath}
+    -c:v rawvideo -an
+    {dst}
+"""
+    try:
+        supervise(cmd, sum(r["duration"] for r in ranges), progresspath)
+    except subprocess.SubprocessError as err:
+        raise DecodeFailed(f"Failed to decode '{listpath}' - {err}")
+
+    return ranges
+
+
+def score_cmd(reference, coded, scorepath, progresspath, scale=None):
+    # upscale coded video to the reference resolution in the same pass
+    inputs = "[0:v][1:v]"
+    if scale is not None:
+        inputs = "[0:v][1:v]scale2ref=flags=bicubic[dist][ref];[dist][ref]"
+
+    vmaf = f"libvmaf=log_fmt=json:log_path={scorepath}:n_subsample=3"
+    return f"""
+ffmpeg -y -hide_banner -v warning -progress {progresspath}
     -i {coded} -i {reference}
-    -filter_complex "[0:v][1:v]libvmaf=log_fmt=json:log_path={scorepath}:n_subsample=3"
+    -filter_complex "{inputs}{vmaf}"
     -f null -
 """
+
+
+def calc_frame_scores(reference, coded, scale=None, duration=None):
+    """
+    Computes per-frame vmaf scores for encoded video content, duration of
+    the reference is probed if not given
+
+    Returns: list of (frame number, score) tuples
+    """
+    if duration is None:
+        duration = probe_duration(reference)
+
+    scorepath = f"{coded}.json"
+    progresspath = f"{coded}.score.progress"
+    rate = score_cmd(reference, coded, scorepath, progresspath, scale)
     try:
-        subprocess.check_call(shlex.split(rate))
-    except subprocess.CalledProcessError:
+        supervise(rate, duration, progresspath)
+    except subprocess.SubprocessError as err:
+        print(f"Scoring '{coded}' failed - {err}")
         return None
 
+    return read_frame_scores(scorepath)
+
+
+def read_frame_scores(scorepath):
+    """Reads per-frame scores from a libvmaf json log"""
     with open(scorepath, "r") as f:
         data = json.load(f)
 
-        return [frame["metrics"]["vmaf"] + 1 for frame in data["frames"]]
+        return [(frame["frameNum"], frame["metrics"]["vmaf"] + 1) for frame in data["frames"]]
 
 
-def transcode(ref, desc, opts, scale, tmpdir):
+def calc_frame_scores_many(reference, codeds, upscale, tmpdir, threads=1, duration=None):
     """
-    Transcodes reference to a specific format and computes the vmaf score
-    of the resulting file.
+    Computes per-frame vmaf scores for multiple encodings of the same
+    reference in a single pass, decoding the reference only once.
 
     | Arguments:
-    | ref: Path to raw YUV reference-file
-    | desc: format descriptor
-    | opts: ffmpeg option string, must contain '-i $ref' as reference input
-    |   placeholder
-    | tmpdir: directory to store temporary files in
-
+    | reference: Path to raw YUV reference-file
+    | codeds: Paths to encoded files
+    | upscale: whether each encoded file needs to be upscaled to reference
+    |   resolution
+    | tmpdir: directory to store score logs in
+    | threads: number of libvmaf threads per encoded file
+    | duration: duration of the reference in seconds, probed if not given
+
+    Returns: list of per-frame scores as returned by calc_frame_scores for
+      each encoded file, None if scoring failed
     """
-    result = {}
+    if duration is None:
+        duration = probe_duration(reference)
 
-    # encode input
-    print(f"Transcoding descriptor: {desc}")
-    codedpath = path.join(tmpdir, f"{desc}.nut")
+    count = len(codeds)
+    scorepaths = [path.join(tmpdir, f"score{i}.json") for i in range(count)]
     progresspath = path.join(tmpdir, "progress")
-    cmd = f"""
-ffmpeg -y -hide_banner -v warning -stats -progress {progresspath}
-{opts.replace("$ref", ref)}
--an
-{codedpath}
+
+    # feed one copy of the reference to each libvmaf instance
+    refs = "".join(f"[ref{i}]" for i in range(count))
+    graph = [f"[{count}:v]split={count}{refs}"]
+    for i, (scorepath, scaled) in enumerate(zip(scorepaths, upscale)):
+        inputs = f"[{i}:v][ref{i}]"
+        if scaled:
+            graph.append(f"{inputs}scale2ref=flags=bicubic[dist{i}][scaled{i}]")
+            inputs = f"[dist{i}][scaled{i}]"
+
+        vmaf = f"libvmaf=log_fmt=json:log_path={scorepath}:n_subsample=3:n_threads={threads}"
+        graph.append(f"{inputs}{vmaf}[out{i}]")
+
+    # paths may come from untrusted clients, keep each one a single argument
+    inputs = " ".join(f"-i {shlex.quote(coded)}" for coded in codeds)
+    outputs = " ".join(f"-map [out{i}] -f null -" for i in range(count))
+    rate = f"""
+ffmpeg -y -hide_banner -v warning -progress {progresspath}
+    {inputs} -i {shlex.quote(reference)}
+    -filter_complex "{';'.join(graph)}"
+    {outputs}
 """
     try:
-        subprocess.check_call(shlex.split(cmd))
-    except subprocess.CalledProcessError as err:
-        raise EncodeFailed(f"Failed at format {desc} - {err}")
+        supervise(rate, duration, progresspath)
+    except subprocess.SubprocessError as err:
+        print(f"Scoring {codeds} failed - {err}")
+        return None
 
-    # read final speed from progress
-    with open(progresspath, "r") as f:
-        progress = f.read().split("progress=continue")[-1]
-        for line in progress.split("\n"):
-            match = re.match("^speed=([\d.]+)x$", line)
-            if match is not None:
-                result["speed"] = float(match[1])
+    return [read_frame_scores(scorepath) for scorepath in scorepaths]
 
-    # probe real coded bitrate
-    result["rate"] = probe_rate(codedpath)
 
-    # calculate vmaf score
-    scores = calc_score(ref, codedpath, scale)
-    if scores is None:
-        raise ScoreFailed(f"Failed to compute score for {desc}")
+def calc_score(reference, coded, scale=None, duration=None):
+    """Computes vmaf scores for encoded video content"""
+    frames = calc_frame_scores(reference, coded, scale, duration)
+    if frames is None:
+        return None
+
+    return [score for _, score in frames]
+
+
+def aggregate_scores(scores):
+    """Calculates different aggregates from per-frame scores"""
+    result = {}
 
-    # Calculate different aggregates
     score_mean = sum(scores) / len(scores)
     print("Mean:", score_mean)
     result["score_mean"] = score_mean
@@ -146,6 +293,271 @@ ffmpeg -y -hide_banner -v warning -stats -progress {progresspath}
     return result
 
 
+def encode_cmd(ref, opts, output, progresspath, keyframes=None, stats=True):
+    """
+    Builds the encoding command, output is the path of the coded file or
+    muxer options such as "-f null -". Console stats are left out if stats
+    is not set.
+    """
+    force = ""
+    if keyframes:
+        expr = "+".join(f"eq(n,{frame})" for frame in keyframes)
+        force = f"-force_key_frames:v expr:{expr}"
+
+        # x264/x265 only turn forced keyframes into closed-gop IDR frames when asked,
+        # otherwise frames before the keyframe may predict from it
+        if re.search(r"\blibx26[45]\b", opts):
+            force += " -forced-idr:v 1"
+
+    return f"""
+ffmpeg -y -hide_banner -v warning {"-stats" if stats else "-nostats"} -progress {progresspath}
+{opts.replace("$ref", ref)}
+{force}
+-an
+{output}
+"""
+
+
+def read_speed(progresspath):
+    """Reads final encoding speed from progress file, None if not present"""
+    speed = None
+    with open(progresspath, "r") as f:
+        progress = f.read().split("progress=continue")[-1]
+        for line in progress.split("\n"):
+            match = re.match("^speed=([\d.]+)x$", line)
+            if match is not None:
+                speed = float(match[1])
+
+    return speed
+
+
+def encode(ref, desc, opts, tmpdir, keyframes=None, duration=None):
+    """
+    Encodes reference to a specific format
+
+    | Arguments:
+    | ref: Path to raw YUV reference-file
+    | desc: format descriptor
+    | opts: ffmpeg option string, must contain '-i $ref' as reference input
+    |   placeholder
+    | tmpdir: directory to store temporary files in
+    | keyframes: frame numbers to force keyframes at
+    | duration: duration of the reference in seconds, probed if not given
+
+    Returns: path of the coded file and the encoding speed
+    """
+    if duration is None:
+        duration = probe_duration(ref)
+
+    print(f"Transcoding descriptor: {desc}")
+    codedpath = path.join(tmpdir, f"{desc}.nut")
+    progresspath = path.join(tmpdir, "progress")
+    cmd = encode_cmd(ref, opts, codedpath, progresspath, keyframes)
+    try:
+        supervise(cmd, duration, progresspath)
+    except subprocess.SubprocessError as err:
+        raise EncodeFailed(f"Failed at format {desc} - {err}")
+
+    return codedpath, read_speed(progresspath)
+
+
+def frame_data(frames, sizes, duration, start=0):
+    """
+    Collects per-frame vmaf scores and coded frame sizes for storage
+
+    | Arguments:
+    | frames: list of (frame number, score) tuples
+    | sizes: coded frame sizes in bytes
+    | duration: duration of the frames in seconds
+    | start: number of the first frame, frame numbers are stored relative to it
+    """
+    return {
+        "duration": duration,
+        "frame": [num - start for num, _ in frames],
+        "vmaf": [score for _, score in frames],
+        "size": sizes,
+    }
+
+
+def transcode(ref, desc, opts, scale, tmpdir, variant=None, duration=None):
+    """
+    Transcodes reference to a specific format and computes the vmaf score
+    of the resulting file. Per-frame scores and sizes are returned as
+    "frames".
+
+    | Arguments:
+    | ref: Path to raw YUV reference-file
+    | desc: format descriptor
+    | opts: ffmpeg option string, must contain '-i $ref' as reference input
+    |   placeholder
+    | scale: resolution of the format, None for reference resolution
+    | tmpdir: directory to store temporary files in
+    | variant: Path to raw YUV reference-file prescaled to scale, which is
+    |   encoded instead of ref
+    | duration: duration of the reference in seconds, probed if not given
+
+    """
+    result = {}
+    if duration is None:
+        duration = probe_duration(ref)
+
+    # encode input
+    codedpath, speed = encode(variant or ref, desc, opts, tmpdir, duration=duration)
+    if speed is not None:
+        result["speed"] = speed
+
+    # probe real coded bitrate and packet sizes
+    probe = ffprobe(codedpath, PACKET_ENTRIES)
+    result["rate"] = parse_rate(probe)
+
+    # calculate vmaf score
+    frames = calc_frame_scores(ref, codedpath, scale, duration)
+    if frames is None:
+        raise ScoreFailed(f"Failed to compute score for {desc}")
+
+    result.update(aggregate_scores([score for _, score in frames]))
+
+    sizes = parse_packet_sizes(probe) or []
+    result["frames"] = frame_data(frames, sizes, duration)
+
+    return result
+
+
+def transcode_batch(ref, desc, opts, ranges, scale, tmpdir, variant=None):
+    """
+    Transcodes concatenated references to a specific format at once and
+    computes the vmaf scores of the resulting file per reference. Per-frame
+    scores and sizes are returned as "frames".
+
+    | Arguments:
+    | ref: Path to raw YUV file of concatenated references
+    | desc: format descriptor
+    | opts: ffmpeg option string, must contain '-i $ref' as reference input
+    |   placeholder
+    | ranges: frame ranges and durations of the references as returned by
+    |   decode_concat
+    | scale: resolution of the format, None for reference resolution
+    | tmpdir: directory to store temporary files in
+    | variant: Path to raw YUV file of concatenated references prescaled to
+    |   scale, which is encoded instead of ref
+
+    Returns: list of results in the order of ranges
+    """
+    # Force keyframes at reference boundaries to keep predictions within a
+    # reference. This relies on the encoder coding forced keyframes as IDR
+    # frames, which is enforced for libx264/libx265 only.
+    keyframes = [r["start"] for r in ranges[1:]]
+    duration = sum(r["duration"] for r in ranges)
+    codedpath, speed = encode(variant or ref, desc, opts, tmpdir, keyframes, duration)
+
+    sizes = probe_packet_sizes(codedpath)
+    if sizes is None:
+        raise EncodeFailed(f"Failed to probe packets for format {desc}")
+
+    frames = calc_frame_scores(ref, codedpath, scale, duration)
+    if frames is None:
+        raise ScoreFailed(f"Failed to compute score for {desc}")
+
+    results = []
+    for r in ranges:
+        print(f"Frames {r['start']}-{r['end']}")
+        refframes = [(num, score) for num, score in frames if r["start"] <= num < r["end"]]
+        if not refframes:
+            raise ScoreFailed(f"No scores for frames {r['start']}-{r['end']} of {desc}")
+
+        # the encoding speed can only be measured for the whole batch
+        result = {"rate": sum(sizes[r["start"]:r["end"]]) * 8 / r["duration"] / 1000}
+        if speed is not None:
+            result["speed"] = speed
+
+        result.update(aggregate_scores([score for _, score in refframes]))
+        result["frames"] = frame_data(refframes, sizes[r["start"]:r["end"]], r["duration"],
+                                      r["start"])
+        results.append(result)
+
+    return results
+
+
+def summarize(values):
+    """Returns median and median absolute deviation of values"""
+    median = statistics.median(values)
+    mad = statistics.median(abs(value - median) for value in values)
+    return median, mad
+
+
+def benchmark(ref, desc, opts, tmpdir, trials=5, warmup=1, score=False, scale=None,
+              variant=None, duration=None):
+    """
+    Repeatedly transcodes reference to a specific format and measures the
+    encoding speed.
+
+    | Arguments:
+    | ref: Path to raw YUV reference-file
+    | desc: format descriptor
+    | opts: ffmpeg option string, must contain '-i $ref' as reference input
+    |   placeholder
+    | tmpdir: directory to store temporary files in
+    | trials: number of measured encodes
+    | warmup: number of unmeasured encodes before the trials
+    | score: keep the coded file and compute rate and vmaf score, otherwise
+    |   encode to the null muxer
+    | scale: resolution of the format, None for reference resolution
+    | variant: Path to raw YUV reference-file prescaled to scale, which is
+    |   encoded instead of ref
+    | duration: duration of the reference in seconds, probed if not given
+
+    """
+    result = {}
+    src = variant or ref
+
+    if duration is None:
+        duration = probe_duration(src)
+    if duration is None:
+        raise EncodeFailed(f"Failed to probe duration of '{ref}'")
+
+    print(f"Benchmarking descriptor: {desc}")
+    codedpath = path.join(tmpdir, f"{desc}.nut")
+    progresspath = path.join(tmpdir, "progress")
+    output = codedpath if score else "-f null -"
+    cmd = encode_cmd(src, opts, output, progresspath, stats=False)
+    measurements = []
+    for trial in range(warmup + trials):
+        try:
+            measurement = supervise(cmd, duration, progresspath)
+        except subprocess.SubprocessError as err:
+            raise EncodeFailed(f"Failed at format {desc} - {err}")
+
+        if trial < warmup:
+            continue
+
+        # speed in multiples of realtime, per wall clock and per fully used core
+        measurement["speed"] = duration / measurement["wall_time"]
+        measurement["cpu_speed"] = duration / measurement["cpu_time"]
+        measurements.append(measurement)
+
+    for key in ["speed", "cpu_speed", "wall_time", "user_time", "sys_time", "cpu_time"]:
+        median, mad = summarize([measurement[key] for measurement in measurements])
+        result[key] = median
+        result[f"{key}_mad"] = mad
+
+    result["max_rss"] = max(measurement["max_rss"] for measurement in measurements)
+    result["trials"] = measurements
+    print(f"Speed: {result['speed']:0.2f}x, per core: {result['cpu_speed']:0.2f}x")
+
+    if not score:
+        return result
+
+    result["rate"] = probe_rate(codedpath)
+
+    scores = calc_score(ref, codedpath, scale, duration)
+    if scores is None:
+        raise ScoreFailed(f"Failed to compute score for {desc}")
+
+    result.update(aggregate_scores(scores))
+
+    return result
+
+
 def valid_reference(ref, tmpdir):
     """
     Tests the scoring of a reference file. A copy encode should yield a score
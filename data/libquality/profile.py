@@ -1,4 +1,8 @@
+import shlex
+import itertools
 import libquality.ffmpeg as ffmpeg
+import libquality.supervisor as supervisor
+from libquality.reference import ensure_variants, ensure_pyramid
 from os import path, makedirs, listdir
 
 
@@ -6,18 +10,35 @@ class InvalidEncodingFormat(Exception):
     pass
 
 
+def normalize_opts(opts):
+    """Normalizes whitespace and quoting of an ffmpeg option string"""
+    return " ".join(shlex.split(opts))
+
+
 class Profile:
     """
     Comparison Profile, contains encoding formats and plots for comparison
+
+    Formats are encoded at reference resolution unless the profile sets a
+    scale like "1280x720" or a format sets its own "scale".
+
+    Besides yielding formats, a profile can declare a parameter grid as dict
+    of parameter name to list of values. Every combination of values is
+    passed to template(), which returns the format for it.
     """
     name = None
     scale = None
     dimensions = []
+    grid = {}
 
     # Override
     def formats(self):
         pass
 
+    # Override
+    def template(self, **params):
+        pass
+
     # Override
     def plot(self, df, plotdir):
         pass
@@ -26,9 +47,26 @@ class Profile:
         # add custom dimensions to base dimensions
         return ["tag", "profile", "reference"] + self.dimensions
 
-    def get_formats(self):
-        result = []
-        for fmt in self.formats():
+    def grid_formats(self):
+        """Lazily expands the parameter grid into formats"""
+        names = list(self.grid)
+        for values in itertools.product(*(self.grid[name] for name in names)):
+            params = dict(zip(names, values))
+            fmt = self.template(**params)
+            if fmt is not None:
+                yield {**params, **fmt}
+
+    def format_key(self, fmt):
+        """Identifies formats which encode the same"""
+        return (normalize_opts(fmt["opts"]), self.get_scale(fmt))
+
+    def iter_formats(self):
+        """
+        Lazily yields all formats, formats which encode the same as an
+        earlier format are skipped
+        """
+        seen = set()
+        for fmt in itertools.chain(self.formats() or [], self.grid_formats()):
             if fmt is None:
                 continue
 
@@ -41,9 +79,25 @@ class Profile:
             if "opts" not in fmt:
                 raise InvalidEncodingFormat(f"Encoding 'opts' not in format {fmt}")
 
-            result.append(fmt)
+            key = self.format_key(fmt)
+            if key in seen:
+                continue
+
+            seen.add(key)
+            yield fmt
+
+    def get_formats(self):
+        return list(self.iter_formats())
+
+    def get_scale(self, fmt):
+        """Returns the resolution a format is encoded at, None for reference resolution"""
+        return fmt.get("scale", self.scale)
 
-        return result
+    def get_scales(self):
+        """Returns all resolutions apart from reference resolution used by formats"""
+        scales = set(self.get_scale(fmt) for fmt in self.iter_formats())
+        scales.discard(None)
+        return scales
 
     def get_descriptor(self, fmt, reference, tag):
         """Generates a unique descriptor for an encoding"""
@@ -57,6 +111,11 @@ class Profile:
         for dim in self.get_dimensions():
             descriptor.append(str(values[dim]))
 
+        # formats may differ only in scale, which need not be a dimension
+        scale = self.get_scale(fmt)
+        if scale is not None and "scale" not in self.get_dimensions():
+            descriptor.append(str(scale))
+
         return "_".join(descriptor)
 
     def annotate_result(self, result, fmt, reference, tag):
@@ -69,33 +128,117 @@ class Profile:
 
         return values
 
-    def process(self, reference, tag, tmpdir):
+    def process(self, reference, tag, tmpdir, benchmark=None, variants=None, failures=None):
         """
         Compute scores from a reference for all formats in this profile
+
+        If benchmark is set to a dict of ffmpeg.benchmark arguments, the
+        formats are benchmarked instead of transcoded once. Scaled formats
+        are encoded from prescaled variants of the reference, which are
+        prepared if not passed in variants.
+
+        Failures are counted per format key in failures, pass the same dict
+        for all references to skip formats failing too often.
         """
         count = 0
+        if failures is None:
+            failures = {}
+
+        if variants is None:
+            variants = ensure_variants(reference, self.get_scales())
 
-        # decode reference
+        # decode reference and all needed variants
         makedirs(tmpdir, exist_ok=True)
         rawref = path.join(tmpdir, "ref.nut")
-        ffmpeg.decode(reference, rawref)
+        duration = ffmpeg.decode(reference, rawref)
+
+        rawvariants = {}
+        for scale in self.get_scales():
+            rawvariants[scale] = path.join(tmpdir, f"ref_{scale}.nut")
+            ffmpeg.decode(variants[scale], rawvariants[scale])
 
         formats = self.get_formats()
         for fmt in formats:
             refname = path.basename(path.splitext(reference)[0])
             desc = self.get_descriptor(fmt, refname, tag)
+            key = self.format_key(fmt)
+
+            if failures.get(key, 0) >= supervisor.settings["quarantine"]:
+                print(f"Skipping quarantined format {desc}")
+            else:
+                try:
+                    variant = rawvariants.get(self.get_scale(fmt))
+                    result = self.process_format(rawref, variant, desc, fmt, tmpdir, benchmark,
+                                                 duration)
+                    yield self.annotate_result(result, fmt, refname, tag)
+
+                except (ffmpeg.EncodeFailed, ffmpeg.ScoreFailed) as err:
+                    print(err)
+                    failures[key] = failures.get(key, 0) + 1
+
+            count += 1
+            percentage = count / len(formats) * 100
+            print(f"{count}/{len(formats)} formats complete ({percentage:0.2f}%)")
+
+    def process_batch(self, references, tag, tmpdir, pyramid=None, failures=None):
+        """
+        Compute scores from all references for all formats in this profile,
+        encoding and scoring the concatenated references once per format,
+        see process for failures
+        """
+        count = 0
+        if failures is None:
+            failures = {}
+
+        if pyramid is None:
+            pyramid = ensure_pyramid(references, self.get_scales())
+
+        # decode and concatenate references and all needed variants
+        makedirs(tmpdir, exist_ok=True)
+        rawref = path.join(tmpdir, "batch.nut")
+        ranges = ffmpeg.decode_concat(references, rawref)
+        refnames = [path.basename(path.splitext(reference)[0]) for reference in references]
+
+        rawvariants = {}
+        for scale in self.get_scales():
+            rawvariants[scale] = path.join(tmpdir, f"batch_{scale}.nut")
+            ffmpeg.decode_concat([pyramid[ref][scale] for ref in references],
+                                 rawvariants[scale])
 
-            try:
-                result = ffmpeg.transcode(rawref, desc, fmt["opts"], self.scale, tmpdir=tmpdir)
-                yield self.annotate_result(result, fmt, refname, tag)
+        formats = self.get_formats()
+        for fmt in formats:
+            desc = self.get_descriptor(fmt, "batch", tag)
+            key = self.format_key(fmt)
+
+            if failures.get(key, 0) >= supervisor.settings["quarantine"]:
+                print(f"Skipping quarantined format {desc}")
+            else:
+                try:
+                    scale = self.get_scale(fmt)
+                    results = ffmpeg.transcode_batch(rawref, desc, fmt["opts"], ranges, scale,
+                                                     tmpdir, rawvariants.get(scale))
+                    for refname, result in zip(refnames, results):
+                        yield self.annotate_result(result, fmt, refname, tag)
 
-            except (ffmpeg.EncodeFailed, ffmpeg.ScoreFailed) as err:
-                print(err)
+                except (ffmpeg.EncodeFailed, ffmpeg.ScoreFailed) as err:
+                    print(err)
+                    failures[key] = failures.get(key, 0) + 1
 
             count += 1
             percentage = count / len(formats) * 100
             print(f"{count}/{len(formats)} formats complete ({percentage:0.2f}%)")
 
+    def process_format(self, rawref, variant, desc, fmt, tmpdir, benchmark=None,
+                       duration=None):
+        """Transcodes or benchmarks a single format"""
+        scale = self.get_scale(fmt)
+        if benchmark is None:
+            return ffmpeg.transcode(rawref, desc, fmt["opts"], scale, tmpdir=tmpdir,
+                                    variant=variant, duration=duration)
+
+        return ffmpeg.benchmark(rawref, desc, fmt["opts"], tmpdir, scale=scale, variant=variant,
+                                duration=duration, **benchmark)
+
 
 def load(parent):
     """load profiles from directory"""
@@ -1,25 +1,71 @@
 import json
 import glob
 from os import path, makedirs
+from libquality.reference import ensure_pyramid
 
 
-def compare(references, profiles, tag, env):
+def process(references, pyramid, profile, tag, env, benchmark=None, batch=False, failures=None):
+    """Yields results for all references of a profile"""
+    if batch:
+        print(f"Processing references: {references}")
+        yield from profile.process_batch(references, tag, env["tmpdir"], pyramid, failures)
+        return
+
+    for reference in references:
+        print(f"Processing reference: {reference}")
+        yield from profile.process(reference, tag, env["tmpdir"], benchmark, pyramid[reference],
+                                   failures)
+
+
+def store_frames(desc, frames, outdir):
+    """Stores per-frame scores and sizes of an encoding"""
+    framedir = path.join(outdir, "frames")
+    makedirs(framedir, exist_ok=True)
+
+    with open(path.join(framedir, f"{desc}.json"), "w") as f:
+        json.dump(frames, f)
+
+
+def compare(references, profiles, tag, env, benchmark=None, batch=False):
+    """
+    Processes all references with all profiles and stores the results
+
+    Benchmark results are stored in benchdir instead of scoredir, so they
+    don't get mixed up with the plotted scores. In batch mode all references
+    are encoded at once per format.
+    """
+    outdir = env["scoredir"] if benchmark is None else env["benchdir"]
+
+    # prepare scaled variants for all profiles at once
+    scales = set()
+    for profile in profiles:
+        scales |= profile.get_scales()
+    pyramid = ensure_pyramid(references, scales)
+
+    # failure count per format key, formats failing too often are quarantined
+    failures = {}
+
     for profile in profiles:
         # store scores per profile
         scores = []
-        scorefile = path.join(env["scoredir"], f"{tag}_{profile.name}.json")
+        scorefile = path.join(outdir, f"{tag}_{profile.name}.json")
 
-        makedirs(env["scoredir"], exist_ok=True)
+        makedirs(outdir, exist_ok=True)
 
         print(f"Processing profile: {profile.name}")
-        for reference in references:
-            print(f"Processing reference: {reference}")
-            for result in profile.process(reference, tag, env["tmpdir"]):
-                scores.append(result)
-
-                # dump after every result to preserve work
-                with open(scorefile, "w") as f:
-                    json.dump(scores, f, indent="  ")
+        for result in process(references, pyramid, profile, tag, env, benchmark, batch,
+                              failures):
+            # store per-frame data separately, so the scores stay small
+            if "frames" in result:
+                frames = result.pop("frames")
+                store_frames(profile.get_descriptor(result, result["reference"], tag), frames,
+                             outdir)
+
+            scores.append(result)
+
+            # dump after every result to preserve work
+            with open(scorefile, "w") as f:
+                json.dump(scores, f, indent="  ")
 
 
 def plot(profiles, env):
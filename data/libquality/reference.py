@@ -1,7 +1,8 @@
 import json
 import subprocess
 import shlex
-from os import path, rename, makedirs, stat
+from os import path, rename, makedirs, stat, remove
+import libquality.supervisor as supervisor
 
 
 class ReferencePrepareFailed(Exception):
@@ -40,17 +41,94 @@ def prepare_reference(src, dst, skip="", duration=""):
     if duration:
         duration = "-to " + duration
 
+    progresspath = f"{dst}.progress"
     cmd = f"""
-ffmpeg -y -hide_banner -v error {skip}
+ffmpeg -y -hide_banner -v error -progress {progresspath} {skip}
     -i {src}
     -c:v ffvhuff -an {duration}
     -r 25 -s 1920x1080 -sws_flags bicubic -pix_fmt yuv420p
     {dst}
 """
+    # downloads have no predictable duration, so only watch for stalls
     try:
-        subprocess.check_call(shlex.split(cmd))
-    except subprocess.CalledProcessError as err:
+        supervisor.run(shlex.split(cmd), stall=supervisor.settings["stall"],
+                       progress=progresspath)
+    except subprocess.SubprocessError as err:
         raise ReferencePrepareFailed(f"Failed to prepare '{src}' - {err}")
+    finally:
+        try:
+            remove(progresspath)
+        except FileNotFoundError:
+            pass
+
+
+def scale_cmd(ref, dst, scale, progresspath):
+    return f"""
+ffmpeg -y -hide_banner -v error -progress {progresspath}
+    -i {ref}
+    -c:v ffvhuff -an
+    -s {scale} -sws_flags bicubic -pix_fmt yuv420p
+    {dst}
+"""
+
+
+def scale_reference(ref, dst, scale):
+    progresspath = f"{dst}.progress"
+    cmd = scale_cmd(ref, dst, scale, progresspath)
+    try:
+        supervisor.run(shlex.split(cmd), stall=supervisor.settings["stall"],
+                       progress=progresspath)
+    except subprocess.SubprocessError as err:
+        raise ReferencePrepareFailed(f"Failed to scale '{ref}' to {scale} - {err}")
+    finally:
+        try:
+            remove(progresspath)
+        except FileNotFoundError:
+            pass
+
+
+def variant_path(ref, scale):
+    """Returns path of the variant of a reference scaled to scale"""
+    return f"{path.splitext(ref)[0]}_{scale}.nut"
+
+
+def variant_fresh(ref, variant):
+    """Checks if a scaled variant exists and is newer than its reference"""
+    try:
+        return stat(variant).st_mtime >= stat(ref).st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def ensure_variants(ref, scales):
+    """
+    Make sure scaled variants of a reference are present for all scales.
+    Variants are stored next to the reference and rebuilt when the
+    reference changes.
+
+    Returns: dict of scale to variant file
+    """
+    variants = {}
+    for scale in sorted(scales):
+        variant = variant_path(ref, scale)
+        if not variant_fresh(ref, variant):
+            tmpvariant = f"{path.splitext(variant)[0]}.tmp.nut"
+            print(f"Scaling reference {ref} to {scale}")
+            scale_reference(ref, tmpvariant, scale)
+            rename(tmpvariant, variant)
+
+        variants[scale] = variant
+
+    return variants
+
+
+def ensure_pyramid(references, scales):
+    """
+    Make sure scaled variants of all references are present for all scales
+
+    Returns: dict of reference to dict of scale to variant file
+    """
+    return {ref: ensure_variants(ref, scales) for ref in references}
 
 
 def ensure_references(sourcefile, env):
@@ -0,0 +1,271 @@
+import json
+import glob
+import hashlib
+import html
+import statistics
+from os import path, makedirs, stat
+
+# bump to regenerate all sections after changing the layout
+VERSION = 1
+
+# maximum number of points per per-frame curve
+CURVE_POINTS = 200
+
+AGGREGATES = ["score_mean", "score_harm_mean", "score_10th_pct", "score_min", "rate", "speed"]
+
+STYLE = """
+body { font-family: sans-serif; margin: 2em; }
+table { border-collapse: collapse; }
+th, td { border: 1px solid #ccc; padding: 0.2em 0.5em; text-align: right; }
+svg { background: #f8f8f8; margin: 0.2em; }
+polyline { fill: none; stroke: #1f77b4; stroke-width: 1; }
+"""
+
+
+def lttb(points, threshold):
+    """
+    Downsamples a curve with the Largest-Triangle-Three-Buckets algorithm,
+    which keeps peaks and dips unlike plain decimation.
+
+    | Arguments:
+    | points: list of (x, y) tuples sorted by x
+    | threshold: number of points to keep
+
+    """
+    if threshold >= len(points) or threshold < 3:
+        return list(points)
+
+    sampled = [points[0]]
+    every = (len(points) - 2) / (threshold - 2)
+    selected = 0
+
+    for i in range(threshold - 2):
+        # average point of the next bucket
+        start = int((i + 1) * every) + 1
+        end = min(int((i + 2) * every) + 1, len(points))
+        avg_x = sum(x for x, _ in points[start:end]) / (end - start)
+        avg_y = sum(y for _, y in points[start:end]) / (end - start)
+
+        # pick point of the current bucket forming the largest triangle
+        ax, ay = points[selected]
+        best_area = -1
+        for j in range(int(i * every) + 1, start):
+            x, y = points[j]
+            area = abs((ax - avg_x) * (y - ay) - (ax - x) * (avg_y - ay))
+            if area > best_area:
+                best_area = area
+                selected = j
+
+        sampled.append(points[selected])
+
+    sampled.append(points[-1])
+    return sampled
+
+
+def load_scores(scoredir):
+    """Loads all stored scores"""
+    scores = []
+    for filename in sorted(glob.iglob(path.join(scoredir, "*.json"))):
+        with open(filename, "r") as f:
+            scores += json.load(f)
+
+    return scores
+
+
+def group_dims(profile, rows):
+    """Returns dimensions identifying a format, including scale if formats set it"""
+    dims = [dim for dim in profile.get_dimensions() if dim != "reference"]
+    if "scale" not in dims and any(row.get("scale") is not None for row in rows):
+        dims.append("scale")
+
+    return dims
+
+
+def aggregate(profile, rows):
+    """
+    Groups results of a profile by format over all references
+
+    Returns: list of (format values, aggregates, results) tuples
+    """
+    dims = group_dims(profile, rows)
+
+    groups = {}
+    for row in rows:
+        key = tuple(str(row.get(dim)) for dim in dims)
+        groups.setdefault(key, []).append(row)
+
+    result = []
+    for key, group in groups.items():
+        values = {}
+        for name in AGGREGATES:
+            present = [row[name] for row in group if row.get(name) is not None]
+            values[name] = statistics.mean(present) if present else None
+
+        result.append((dict(zip(dims, key)), values, group))
+
+    return result
+
+
+def curves(frames):
+    """
+    Converts stored per-frame data to downsampled vmaf and bitrate curves
+
+    Returns: vmaf and bitrate in kbit/s as lists of (frame, value) tuples
+    """
+    vmaf = lttb(list(zip(frames["frame"], frames["vmaf"])), CURVE_POINTS)
+
+    sizes = frames.get("size") or []
+    fps = 1
+    if sizes and frames.get("duration"):
+        fps = len(sizes) / frames["duration"]
+
+    rate = lttb([(i, size * 8 * fps / 1000) for i, size in enumerate(sizes)], CURVE_POINTS)
+
+    return vmaf, rate
+
+
+def svg(points, ymax, title, width=400, height=80):
+    """Renders a curve as inline svg"""
+    if not points:
+        return ""
+
+    xmax = max(points[-1][0], 1)
+    ymax = ymax or 1
+    coords = " ".join(
+        f"{x / xmax * width:0.1f},{height - min(y / ymax, 1) * height:0.1f}" for x, y in points)
+
+    return f"""<svg width="{width}" height="{height}"><title>{html.escape(title)}</title>\
+<polyline points="{coords}"/></svg>"""
+
+
+def fmt_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return f"{value:0.2f}"
+    return html.escape(str(value))
+
+
+def render_section(profile, rows, framedir):
+    """Renders the report section of a profile"""
+    groups = aggregate(profile, rows)
+    dims = group_dims(profile, rows)
+
+    out = [f"<h1>{html.escape(profile.name)}</h1>", "<table>", "<tr>"]
+    out += [f"<th>{html.escape(name)}</th>" for name in dims + AGGREGATES]
+    out.append("</tr>")
+    for values, aggregates, _ in groups:
+        out.append("<tr>")
+        out += [f"<td>{fmt_value(values[dim])}</td>" for dim in dims]
+        out += [f"<td>{fmt_value(aggregates[name])}</td>" for name in AGGREGATES]
+        out.append("</tr>")
+    out.append("</table>")
+
+    # per-frame curves per format and reference
+    for values, _, group in groups:
+        label = " ".join(str(values[dim]) for dim in dims)
+        out.append(f"<details><summary>{html.escape(label)}</summary>")
+
+        for row in group:
+            desc = profile.get_descriptor(row, row["reference"], row["tag"])
+            out.append(f"<h3>{html.escape(row['reference'])}</h3>")
+            try:
+                with open(path.join(framedir, f"{desc}.json"), "r") as f:
+                    frames = json.load(f)
+            except FileNotFoundError:
+                out.append("<p>No per-frame data</p>")
+                continue
+
+            vmaf, rate = curves(frames)
+            ratemax = max((y for _, y in rate), default=0)
+            out.append(svg(vmaf, 100, "VMAF per frame"))
+            out.append(svg(rate, ratemax, f"Bitrate per frame, max {ratemax:0.0f} kbit/s"))
+
+        out.append("</details>")
+
+    return page(profile.name, "\n".join(out))
+
+
+def page(title, body):
+    return f"""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{html.escape(title)}</title>
+<style>{STYLE}</style></head>
+<body>
+{body}
+</body></html>
+"""
+
+
+def section_hash(profile, rows, framedir):
+    """Hashes all inputs of a section, per-frame data by size and mtime"""
+    hasher = hashlib.sha1()
+    hasher.update(json.dumps([VERSION, rows], sort_keys=True).encode("utf-8"))
+
+    for row in rows:
+        desc = profile.get_descriptor(row, row["reference"], row["tag"])
+        try:
+            st = stat(path.join(framedir, f"{desc}.json"))
+            hasher.update(f"{desc}:{st.st_size}:{st.st_mtime_ns}".encode("utf-8"))
+        except FileNotFoundError:
+            pass
+
+    return hasher.hexdigest()
+
+
+def write(filename, content):
+    with open(filename, "w") as f:
+        f.write(content)
+
+
+def generate(profiles, env):
+    """
+    Generates a static html report with one section per profile.
+    Only sections whose scores or per-frame data changed are rewritten.
+
+    Returns: list of rewritten files
+    """
+    reportdir = env["reportdir"]
+    framedir = path.join(env["scoredir"], "frames")
+    manifestpath = path.join(reportdir, "manifest.json")
+    makedirs(reportdir, exist_ok=True)
+
+    try:
+        with open(manifestpath, "r") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+
+    scores = load_scores(env["scoredir"])
+    written = []
+
+    for profile in profiles:
+        filename = f"{profile.name}.html"
+        rows = [row for row in scores if row.get("profile") == profile.name]
+        digest = section_hash(profile, rows, framedir)
+        if manifest.get(filename) == digest and path.exists(path.join(reportdir, filename)):
+            continue
+
+        print(f"Writing report section: {filename}")
+        write(path.join(reportdir, filename), render_section(profile, rows, framedir))
+        manifest[filename] = digest
+        written.append(filename)
+
+    links = "\n".join(
+        f'<li><a href="{html.escape(profile.name)}.html">{html.escape(profile.name)}</a></li>'
+        for profile in profiles)
+    index = page("Quality report", f"<h1>Quality report</h1>\n<ul>\n{links}\n</ul>")
+
+    indexpath = path.join(reportdir, "index.html")
+    try:
+        with open(indexpath, "r") as f:
+            changed = f.read() != index
+    except FileNotFoundError:
+        changed = True
+
+    if changed:
+        write(indexpath, index)
+        written.append("index.html")
+
+    write(manifestpath, json.dumps(manifest, indent="  "))
+
+    return written
@@ -0,0 +1,331 @@
+import json
+import os
+import shutil
+import socket
+import socketserver
+import stat
+import tempfile
+import threading
+import http.client
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, urlencode
+from os import path, makedirs
+import libquality.ffmpeg as ffmpeg
+
+
+class UnknownReference(Exception):
+    pass
+
+
+class Scorer:
+    """
+    Keeps decoded references resident and schedules vmaf scoring of coded
+    files on a pool of workers. Pending jobs for the same reference are
+    batched into a single libvmaf pass.
+    """
+
+    def __init__(self, references, tmpdir, workers=None, batch=4):
+        cpus = os.cpu_count() or 1
+        self.workers = workers or max(1, cpus // 4)
+        self.threads = max(1, cpus // self.workers)
+        self.batch = batch
+        self.tmpdir = tmpdir
+        makedirs(tmpdir, exist_ok=True)
+
+        # decode references once for the lifetime of the service
+        self.references = {}
+        self.durations = {}
+        for reference in references:
+            name = path.basename(path.splitext(reference)[0])
+            rawref = path.join(tmpdir, f"{name}.ref.nut")
+            print(f"Decoding reference: {reference}")
+            self.durations[name] = ffmpeg.decode(reference, rawref)
+            self.references[name] = rawref
+
+        self.queue = []
+        self.closed = False
+        self.cond = threading.Condition()
+        self.pool = [threading.Thread(target=self.work, daemon=True) for _ in range(self.workers)]
+        for worker in self.pool:
+            worker.start()
+
+    def submit(self, reference, coded, upscale=False):
+        """
+        Queues a coded file for scoring against a reference, upscale coded
+        files encoded at a lower resolution than the reference
+
+        Returns: Future resolving to per-frame scores
+        """
+        if reference not in self.references:
+            raise UnknownReference(f"Unknown reference '{reference}'")
+
+        job = {"reference": reference, "coded": coded, "upscale": upscale, "future": Future()}
+        with self.cond:
+            self.queue.append(job)
+            self.cond.notify()
+
+        return job["future"]
+
+    def score(self, reference, coded, upscale=False, frames=False):
+        """
+        Scores a coded file against a reference and waits for the result
+
+        Returns: dict of score aggregates, per-frame scores as "frames" if set
+        """
+        scores = self.submit(reference, coded, upscale).result()
+        result = ffmpeg.aggregate_scores([score for _, score in scores])
+        if frames:
+            result["frames"] = scores
+
+        return result
+
+    def next_batch(self):
+        """Takes pending jobs for the reference waiting longest"""
+        with self.cond:
+            while not self.queue and not self.closed:
+                self.cond.wait()
+
+            if not self.queue:
+                return None
+
+            reference = self.queue[0]["reference"]
+            batch = [job for job in self.queue if job["reference"] == reference][:self.batch]
+            for job in batch:
+                self.queue.remove(job)
+
+            return batch
+
+    def work(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+
+            self.run_batch(batch)
+
+    def run_batch(self, batch):
+        reference = batch[0]["reference"]
+        rawref = self.references[reference]
+        scoredir = tempfile.mkdtemp(dir=self.tmpdir)
+        try:
+            results = ffmpeg.calc_frame_scores_many(
+                rawref, [job["coded"] for job in batch], [job["upscale"] for job in batch],
+                scoredir, self.threads, self.durations.get(reference))
+
+            # a single broken file fails the whole pass, so retry one by one
+            if results is None and len(batch) > 1:
+                for job in batch:
+                    self.run_batch([job])
+                return
+
+            for job, scores in zip(batch, results or [None]):
+                if scores:
+                    job["future"].set_result(scores)
+                else:
+                    job["future"].set_exception(
+                        ffmpeg.ScoreFailed(f"Failed to compute score for {job['coded']}"))
+
+        except Exception as err:
+            for job in batch:
+                if not job["future"].done():
+                    job["future"].set_exception(err)
+        finally:
+            shutil.rmtree(scoredir, ignore_errors=True)
+
+    def close(self):
+        """Stops workers after pending jobs are done"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+        for worker in self.pool:
+            worker.join()
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    | GET /references: list names of available references
+    | POST /score: score a coded file, either as json body with "reference",
+    |   "path", "upscale" and "frames" or as raw upload with these values as
+    |   query parameters. "upscale" and "frames" are booleans.
+    """
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/references":
+            return self.reply(404, {"error": "Not found"})
+
+        self.reply(200, sorted(self.server.scorer.references))
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/score":
+            return self.reply(404, {"error": "Not found"})
+
+        upload = None
+
+        try:
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+            except ValueError:
+                length = -1
+            if length < 0:
+                return self.reply(400, {"error": "Invalid Content-Length"})
+
+            body = self.rfile.read(length)
+            content_type = self.headers.get("Content-Type", "").split(";")[0].strip()
+            if content_type == "application/json":
+                request = json.loads(body.decode("utf-8"))
+                if not isinstance(request, dict):
+                    return self.reply(400, {"error": "Expected json object"})
+            else:
+                request = {key: values[0] for key, values in parse_qs(url.query).items()}
+                for key in ["frames", "upscale"]:
+                    request[key] = request.get(key) in ["1", "true"]
+
+                fd, upload = tempfile.mkstemp(dir=self.server.scorer.tmpdir, suffix=".upload")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(body)
+                request["path"] = upload
+
+            if "reference" not in request or "path" not in request:
+                return self.reply(400, {"error": "Missing reference or coded file"})
+
+            for key in ["upscale", "frames"]:
+                if not isinstance(request.get(key, False), bool):
+                    return self.reply(400, {"error": f"'{key}' must be a boolean"})
+
+            if request["reference"] not in self.server.scorer.references:
+                raise UnknownReference(f"Unknown reference '{request['reference']}'")
+
+            # only accept existing files, never ffmpeg urls or options
+            coded = request["path"]
+            if not isinstance(coded, str) or not path.isfile(coded):
+                return self.reply(400, {"error": f"Coded file '{coded}' not found"})
+
+            result = self.server.scorer.score(
+                request["reference"], path.abspath(coded), request.get("upscale", False),
+                request.get("frames", False))
+            self.reply(200, result)
+
+        except ValueError as err:
+            self.reply(400, {"error": str(err)})
+        except UnknownReference as err:
+            self.reply(404, {"error": str(err)})
+        except ffmpeg.ScoreFailed as err:
+            self.reply(422, {"error": str(err)})
+        except Exception as err:
+            self.reply(500, {"error": str(err)})
+        finally:
+            if upload is not None:
+                os.remove(upload)
+
+    def reply(self, status, data):
+        content = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def address_string(self):
+        # unix sockets have no client address
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def create_server(address, scorer):
+    """
+    Creates a scoring server listening on "host:port" or "unix:/path"
+    """
+    if address.startswith("unix:"):
+        sockpath = address[len("unix:"):]
+        # only replace stale sockets, never other files
+        try:
+            if not stat.S_ISSOCK(os.stat(sockpath).st_mode):
+                raise FileExistsError(f"'{sockpath}' exists and is not a socket")
+            os.remove(sockpath)
+        except FileNotFoundError:
+            pass
+        server = UnixHTTPServer(sockpath, Handler)
+    else:
+        host, port = address.rsplit(":", 1)
+        server = ThreadingHTTPServer((host, int(port)), Handler)
+
+    server.scorer = scorer
+    return server
+
+
+def serve(address, scorer):
+    """Serves scoring requests until interrupted"""
+    server = create_server(address, scorer)
+    print(f"Listening on {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scorer.close()
+        if address.startswith("unix:"):
+            try:
+                os.remove(address[len("unix:"):])
+            except FileNotFoundError:
+                pass
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, sockpath, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.sockpath = sockpath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.sockpath)
+
+
+class Client:
+    """Client for a scoring server listening on "host:port" or "unix:/path" """
+
+    def __init__(self, address, timeout=None):
+        self.address = address
+        self.timeout = timeout
+
+    def connect(self):
+        if self.address.startswith("unix:"):
+            return UnixHTTPConnection(self.address[len("unix:"):], self.timeout)
+
+        host, port = self.address.rsplit(":", 1)
+        return http.client.HTTPConnection(host, int(port), timeout=self.timeout)
+
+    def request(self, method, url, body=None, headers=None):
+        """Returns: status and decoded json response"""
+        conn = self.connect()
+        try:
+            conn.request(method, url, body, headers or {})
+            response = conn.getresponse()
+            return response.status, json.loads(response.read().decode("utf-8"))
+        finally:
+            conn.close()
+
+    def references(self):
+        return self.request("GET", "/references")
+
+    def score(self, reference, coded, upscale=False, frames=False):
+        """Scores a coded file on the server's filesystem"""
+        body = json.dumps({"reference": reference, "path": coded, "upscale": upscale,
+                           "frames": frames})
+        return self.request("POST", "/score", body, {"Content-Type": "application/json"})
+
+    def upload(self, reference, coded, upscale=False, frames=False):
+        """Uploads a coded file and scores it"""
+        query = urlencode({"reference": reference, "upscale": int(upscale),
+                           "frames": int(frames)})
+
+        with open(coded, "rb") as f:
+            return self.request("POST", f"/score?{query}", f.read(),
+                                {"Content-Type": "application/octet-stream"})
@@ -0,0 +1,216 @@
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+# Supervision settings for all ffmpeg/ffprobe jobs
+settings = {
+    # slowest expected encoding speed in multiples of realtime, used to derive deadlines
+    "min_speed": 0.05,
+    # seconds added to every derived deadline for process startup
+    "grace": 60,
+    # deadline in seconds for jobs without known media duration such as probes
+    "timeout": 300,
+    # seconds without progress output after which a job counts as stalled
+    "stall": 120,
+    # number of retries for hung or crashed jobs
+    "retries": 2,
+    # seconds to wait before the first retry, doubled for every further retry
+    "backoff": 5,
+    # number of failures after which a format is skipped for the rest of the sweep
+    "quarantine": 2,
+}
+
+POLL_INTERVAL = 0.5
+
+
+class JobTimeout(subprocess.SubprocessError):
+    pass
+
+
+class JobStalled(subprocess.SubprocessError):
+    pass
+
+
+def configure(**kwargs):
+    """Updates supervision settings, ignores unset (None) values"""
+    for key, value in kwargs.items():
+        if key not in settings:
+            raise KeyError(f"Unknown supervision setting '{key}'")
+
+        if value is not None:
+            settings[key] = value
+
+
+def deadline_for(duration):
+    """
+    Derives a job deadline in seconds from the duration of the processed media
+
+    Returns: None if duration is unknown
+    """
+    if duration is None:
+        return None
+
+    return duration / settings["min_speed"] + settings["grace"]
+
+
+def activity(progress):
+    """Returns a token which changes whenever the progress file is written"""
+    try:
+        st = os.stat(progress)
+    except FileNotFoundError:
+        return None
+
+    return (st.st_size, st.st_mtime_ns)
+
+
+def run_once(cmd, deadline=None, stall=None, progress=None, capture=False):
+    """
+    Runs a command once, kills it if it exceeds its deadline or if its
+    progress file doesn't change for stall seconds.
+
+    Returns: dict with wall time, user/system cpu time in seconds and peak
+      resident set size in KiB of the child process and its output if
+      capture is set
+    """
+    stdout = tempfile.TemporaryFile() if capture else None
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=stdout)
+
+    done = False
+    failure = None
+    lock = threading.Lock()
+    finished = threading.Event()
+
+    def watch():
+        nonlocal failure
+        last = activity(progress) if progress else None
+        last_change = time.monotonic()
+
+        while not finished.wait(POLL_INTERVAL):
+            now = time.monotonic()
+            if progress and stall is not None:
+                current = activity(progress)
+                if current != last:
+                    last = current
+                    last_change = now
+
+            if deadline is not None and now - start > deadline:
+                err = JobTimeout(f"Killed '{cmd[0]}' after deadline of {deadline:0.0f}s")
+            elif progress and stall is not None and now - last_change > stall:
+                err = JobStalled(f"Killed '{cmd[0]}' after {stall:0.0f}s without progress")
+            else:
+                continue
+
+            # a job exiting on its own in the meantime has not failed
+            with lock:
+                if not done:
+                    failure = err
+                    proc.kill()
+            return
+
+    watchdog = threading.Thread(target=watch, daemon=True)
+    watchdog.start()
+
+    try:
+        # wait without reaping so the watchdog can never kill a reused pid
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        wall = time.monotonic() - start
+        with lock:
+            done = True
+        finished.set()
+
+        # wait4 gives us the rusage of exactly this child
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    except BaseException:
+        with lock:
+            if not done:
+                done = True
+                proc.kill()
+                proc.wait()
+        finished.set()
+        raise
+    finally:
+        watchdog.join()
+
+    try:
+        if failure is not None:
+            raise failure
+
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+        result = {
+            "wall_time": wall,
+            "user_time": usage.ru_utime,
+            "sys_time": usage.ru_stime,
+            "cpu_time": usage.ru_utime + usage.ru_stime,
+            "max_rss": usage.ru_maxrss,
+        }
+
+        if capture:
+            stdout.seek(0)
+            result["output"] = stdout.read()
+
+        return result
+    finally:
+        if stdout is not None:
+            stdout.close()
+
+
+def retryable(err):
+    """Hung jobs and jobs killed by a signal are worth retrying, error exits are not"""
+    if isinstance(err, (JobTimeout, JobStalled)):
+        return True
+
+    return isinstance(err, subprocess.CalledProcessError) and err.returncode < 0 \
+        and err.returncode != -signal.SIGINT
+
+
+def retry_delay(err, attempt, retries):
+    """
+    Decides whether a failed attempt is retried
+
+    Returns: seconds to wait before the next attempt, None to give up
+    """
+    if attempt >= retries or not retryable(err):
+        return None
+
+    delay = settings["backoff"] * 2 ** attempt
+    print(f"{err}, retrying in {delay}s")
+    return delay
+
+
+def run(cmd, deadline=None, stall=None, progress=None, capture=False, retries=None):
+    """
+    Runs a command under supervision, retrying it with exponential backoff if
+    it hangs or crashes.
+
+    | Arguments:
+    | cmd: command as list of arguments
+    | deadline: seconds after which the job is killed
+    | stall: seconds without changes to progress after which the job is killed
+    | progress: path of the file the job writes its progress to
+    | capture: capture and return stdout of the job
+    | retries: number of retries, defaults to the configured setting
+
+    Raises: JobTimeout, JobStalled or subprocess.CalledProcessError after the
+      last failed attempt
+    """
+    if retries is None:
+        retries = settings["retries"]
+
+    attempt = 0
+    while True:
+        try:
+            return run_once(cmd, deadline, stall, progress, capture)
+        except subprocess.SubprocessError as err:
+            delay = retry_delay(err, attempt, retries)
+            if delay is None:
+                raise
+
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,82 @@
+import unittest
+import asyncio
+import shutil
+import subprocess
+import sys
+from os import path, listdir
+import libquality.aio as aio
+import libquality.supervisor as supervisor
+import libquality.profile as profile
+
+basedir = path.dirname(path.realpath(__file__))
+profiles = profile.load("profiles")
+
+
+class TestProcess(unittest.TestCase):
+    def test_run(self):
+        asyncio.run(aio.run_job([sys.executable, "-c", "pass"]))
+
+    def test_capture(self):
+        output = asyncio.run(aio.run_job([sys.executable, "-c", "print('hello')"],
+                                         capture=True))
+        self.assertEqual(output.strip(), b"hello")
+
+    def test_failed(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            asyncio.run(aio.run_job([sys.executable, "-c", "exit(1)"]))
+
+    def test_timeout(self):
+        with self.assertRaises(supervisor.JobTimeout):
+            asyncio.run(aio.run_job([sys.executable, "-c", "import time; time.sleep(10)"],
+                                    deadline=1, retries=0))
+
+    def test_cancel(self):
+        async def cancel():
+            task = asyncio.ensure_future(
+                aio.run_job([sys.executable, "-c", "import time; time.sleep(10)"]))
+            await asyncio.sleep(0.5)
+            task.cancel()
+            await task
+
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(cancel())
+
+
+class Shared(profile.Profile):
+    """Shares the libx264 format with the simple profile"""
+    name = "shared"
+    dimensions = ["preset"]
+    grid = {"preset": ["medium", "medium", None]}
+
+    def template(self, preset):
+        if preset is None:
+            return {"opts": "-i $ref  -c:v   libx264", "preset": "default"}
+
+        return {"opts": f"-i $ref -c:v libx264 -preset:v {preset}"}
+
+
+class TestRun(unittest.TestCase):
+    tmpdir = path.join(basedir, "tmp/aio")
+
+    def test_run(self):
+        reference = path.join(basedir, "fixtures/reference.nut")
+        simple = profiles["simple"].Profile()
+        shared = Shared()
+
+        async def collect():
+            return [result async for result in aio.run([simple, shared], [reference], "testing",
+                                                       self.tmpdir, concurrency=2)]
+
+        results = asyncio.run(collect())
+        self.assertEqual(len(results), len(simple.get_formats()) + 2)
+        for result in results:
+            self.assertEqual(result["reference"], "reference")
+            self.assertGreater(result["score_mean"], 50)
+
+        # simple profile's libx264 format is only encoded once
+        coded = [f for f in listdir(self.tmpdir) if f.startswith("reference_")
+                 and f.endswith(".json")]
+        self.assertEqual(len(coded), len(simple.get_formats()) + 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
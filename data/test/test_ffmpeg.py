@@ -30,6 +30,24 @@ class TestFFmpeg(unittest.TestCase):
         with self.assertRaises(ffmpeg.DecodeFailed):
             ffmpeg.decode(reference, dst)
 
+    def test_benchmark(self):
+        reference = path.join(basedir, "fixtures/reference.nut")
+        result = ffmpeg.benchmark(reference, "bench", "-i $ref -c:v copy", self.tmpdir,
+                                  trials=3, warmup=1)
+        self.assertEqual(len(result["trials"]), 3)
+        self.assertGreater(result["speed"], 0)
+        self.assertGreater(result["max_rss"], 0)
+        self.assertNotIn("score_mean", result)
+
+    def test_encodeCmd(self):
+        cmd = ffmpeg.encode_cmd("ref.nut", "-i $ref -c:v libx264", "-f null -", "progress",
+                                stats=False)
+        self.assertIn("-nostats", cmd)
+        self.assertTrue(cmd.strip().endswith("-an\n-f null -"))
+
+    def test_summarize(self):
+        self.assertEqual(ffmpeg.summarize([1, 2, 3, 4, 10]), (3, 1))
+
     def setUp(self):
         makedirs(self.tmpdir, exist_ok=True)
 
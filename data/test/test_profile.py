@@ -3,6 +3,7 @@ import shutil
 import pandas as pd
 from os import path, makedirs
 import libquality.profile as profile
+import libquality.supervisor as supervisor
 
 basedir = path.dirname(path.realpath(__file__))
 profiles = profile.load("profiles")
@@ -64,6 +65,7 @@ class TestProcess(unittest.TestCase):
 
     def setUp(self):
         self.profile = profiles["simple"].Profile()
+        self.settings = dict(supervisor.settings)
 
     def test_process(self):
         reference = path.join(basedir, "fixtures/reference.nut")
@@ -85,5 +87,67 @@ class TestProcess(unittest.TestCase):
                 else:
                     self.assertEqual(got[key], expected[key], msg=msg)
 
+    def test_processBatch(self):
+        reference = path.join(basedir, "fixtures/reference.nut")
+        results = list(self.profile.process_batch([reference, reference], "testing", self.tmpdir))
+        self.assertEqual(len(results), 2 * len(self.profile.get_formats()))
+
+        # both halves of the batch are the same reference
+        for first, second in zip(results[::2], results[1::2]):
+            self.assertEqual(first["reference"], "reference")
+            self.assertEqual(first["codec"], second["codec"])
+            self.assertAlmostEqual(first["score_mean"], second["score_mean"], delta=5)
+
+    def test_quarantine(self):
+        class Broken(profile.Profile):
+            name = "broken"
+            attempts = 0
+
+            def formats(self):
+                yield {"opts": "-i $ref -c:v nonexistant"}
+
+            def process_format(self, *args, **kwargs):
+                self.attempts += 1
+                return super().process_format(*args, **kwargs)
+
+        reference = path.join(basedir, "fixtures/reference.nut")
+        broken = Broken()
+        failures = {}
+        supervisor.configure(quarantine=2)
+        for _ in range(3):
+            self.assertEqual(list(broken.process(reference, "testing", self.tmpdir,
+                                                 failures=failures)), [])
+
+        # failed on the first two references, skipped on the third
+        self.assertEqual(broken.attempts, 2)
+        self.assertEqual(list(failures.values()), [2])
+
+    def test_scales(self):
+        class Scaled(profile.Profile):
+            name = "scaled"
+            scale = "1280x720"
+
+            def formats(self):
+                yield {"opts": "-i $ref -c:v libx264"}
+                yield {"opts": "-i $ref -c:v libx264", "scale": "640x360"}
+                yield {"opts": "-i $ref -c:v libx264", "scale": None}
+
+        self.assertEqual(Scaled().get_scales(), {"1280x720", "640x360"})
+        self.assertEqual(self.profile.get_scales(), set())
+
+    def test_grid(self):
+        class Grid(profile.Profile):
+            name = "grid"
+            dimensions = ["codec", "crf"]
+            grid = {"codec": ["libx264", "libx265"], "crf": [20, 20.0, 30]}
+
+            def template(self, codec, crf):
+                return {"opts": f"-i $ref  -c:v {codec}   -crf:v {crf:g}"}
+
+        formats = Grid().get_formats()
+        self.assertEqual([(fmt["codec"], fmt["crf"]) for fmt in formats], [
+            ("libx264", 20), ("libx264", 30), ("libx265", 20), ("libx265", 30)])
+
     def tearDown(self):
+        supervisor.settings.update(self.settings)
         shutil.rmtree(self.tmpdir, ignore_errors=True)
@@ -1,7 +1,7 @@
 import unittest
 import shutil
 import time
-from os import path, stat
+from os import path, stat, makedirs
 import libquality.reference as reference
 
 basedir = path.dirname(path.realpath(__file__))
@@ -39,5 +39,21 @@ class TestEnsure(unittest.TestCase):
             # files should be new
             self.assertTrue(st.st_ctime > now)
 
+    def test_ensureVariants(self):
+        makedirs(self.refdir, exist_ok=True)
+        ref = path.join(self.refdir, "reference.nut")
+        shutil.copy(path.join(basedir, "fixtures/reference.nut"), ref)
+
+        variants = reference.ensure_variants(ref, {"640x360", "320x180"})
+        self.assertEqual(variants, {
+            "640x360": path.join(self.refdir, "reference_640x360.nut"),
+            "320x180": path.join(self.refdir, "reference_320x180.nut"),
+        })
+
+        # variants are cached
+        mtime = stat(variants["640x360"]).st_mtime
+        reference.ensure_variants(ref, {"640x360"})
+        self.assertEqual(stat(variants["640x360"]).st_mtime, mtime)
+
     def tearDown(self):
         shutil.rmtree(self.refdir, ignore_errors=True)
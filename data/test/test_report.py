@@ -0,0 +1,110 @@
+import unittest
+import shutil
+import json
+from os import path, makedirs
+import libquality.profile as profile
+import libquality.report as report
+
+basedir = path.dirname(path.realpath(__file__))
+profiles = profile.load("profiles")
+
+
+def mockFrames(count):
+    return {
+        "duration": count / 25,
+        "frame": list(range(0, count, 3)),
+        "vmaf": [90 + i % 7 for i in range(0, count, 3)],
+        "size": [1000 + i % 25 * 100 for i in range(count)],
+    }
+
+
+class TestLTTB(unittest.TestCase):
+    def test_downsample(self):
+        points = [(i, i % 10) for i in range(1000)]
+        sampled = report.lttb(points, 100)
+        self.assertEqual(len(sampled), 100)
+        self.assertEqual(sampled[0], points[0])
+        self.assertEqual(sampled[-1], points[-1])
+        self.assertEqual(sampled, sorted(sampled))
+
+    def test_keepsPeaks(self):
+        points = [(i, 0) for i in range(1000)]
+        points[500] = (500, 100)
+        self.assertIn((500, 100), report.lttb(points, 20))
+
+    def test_short(self):
+        points = [(i, i) for i in range(10)]
+        self.assertEqual(report.lttb(points, 100), points)
+
+
+class TestReport(unittest.TestCase):
+    tmpdir = path.join(basedir, "tmp/report")
+
+    def setUp(self):
+        self.env = {
+            "scoredir": path.join(self.tmpdir, "scores"),
+            "reportdir": path.join(self.tmpdir, "report"),
+        }
+        makedirs(path.join(self.env["scoredir"], "frames"))
+        self.profiles = [profiles[name].Profile() for name in ["simple", "voc_streaming"]]
+        for p in self.profiles:
+            self.store(p, 90)
+
+    def store(self, p, score):
+        results = []
+        for reference in ["ref1", "ref2"]:
+            for fmt in p.get_formats():
+                result = p.annotate_result({"score_mean": score, "rate": 1000}, fmt, reference,
+                                           "tag")
+                results.append(result)
+
+                desc = p.get_descriptor(fmt, reference, "tag")
+                with open(path.join(self.env["scoredir"], "frames", f"{desc}.json"), "w") as f:
+                    json.dump(mockFrames(1000), f)
+
+        with open(path.join(self.env["scoredir"], f"tag_{p.name}.json"), "w") as f:
+            json.dump(results, f)
+
+    def test_generate(self):
+        written = report.generate(self.profiles, self.env)
+        self.assertEqual(written, ["simple.html", "voc-streaming.html", "index.html"])
+
+        with open(path.join(self.env["reportdir"], "simple.html"), "r") as f:
+            content = f.read()
+        self.assertIn("<polyline", content)
+        self.assertIn("libx264", content)
+
+    def test_incremental(self):
+        report.generate(self.profiles, self.env)
+        self.assertEqual(report.generate(self.profiles, self.env), [])
+
+        self.store(self.profiles[0], 80)
+        self.assertEqual(report.generate(self.profiles, self.env), ["simple.html"])
+
+    def test_scaledFrames(self):
+        class Ladder(profile.Profile):
+            name = "ladder"
+            dimensions = ["codec"]
+
+            def formats(self):
+                for scale in [None, "1280x720"]:
+                    yield {"codec": "libx264", "opts": "-i $ref -c:v libx264", "scale": scale}
+
+        p = Ladder()
+        descs = [p.get_descriptor(fmt, "ref", "tag") for fmt in p.get_formats()]
+        self.assertEqual(descs, ["tag_ladder_ref_libx264", "tag_ladder_ref_libx264_1280x720"])
+
+        rows = [p.annotate_result({"score_mean": 1}, fmt, "ref", "tag") for fmt in p.get_formats()]
+        self.assertEqual(len(report.aggregate(p, rows)), 2)
+
+    def test_aggregate(self):
+        p = self.profiles[0]
+        rows = [p.annotate_result({"score_mean": i}, {"codec": "x", "opts": ""}, f"ref{i}", "tag")
+                for i in range(3)]
+        groups = report.aggregate(p, rows)
+        self.assertEqual(len(groups), 1)
+        self.assertEqual(groups[0][1]["score_mean"], 1)
+        self.assertIsNone(groups[0][1]["speed"])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
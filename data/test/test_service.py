@@ -0,0 +1,133 @@
+import unittest
+import json
+import shutil
+import shlex
+import subprocess
+import threading
+from os import path, makedirs
+import libquality.service as service
+
+basedir = path.dirname(path.realpath(__file__))
+
+
+def synthetic(dst, opts):
+    """Creates a short synthetic test video"""
+    subprocess.check_call(shlex.split(f"""
+ffmpeg -y -hide_banner -v error
+    -f lavfi -i testsrc=size=320x240:rate=25 -t 1
+    {opts} -pix_fmt yuv420p {dst}
+"""))
+
+
+class ServiceTest(unittest.TestCase):
+    tmpdir = path.join(basedir, "tmp/service")
+    references = []
+
+    def setUp(self):
+        makedirs(self.tmpdir, exist_ok=True)
+        self.scorer = service.Scorer(self.references, path.join(self.tmpdir, "scorer"),
+                                     workers=2)
+        self.address = f"unix:{path.join(self.tmpdir, 'score.sock')}"
+        self.server = service.create_server(self.address, self.scorer)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = service.Client(self.address, timeout=60)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.scorer.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+class TestRequests(ServiceTest):
+    def test_references(self):
+        self.assertEqual(self.client.references(), (200, []))
+
+    def test_unknownReference(self):
+        status, result = self.client.score("nonexistant", "/nonexistant.nut")
+        self.assertEqual(status, 404)
+        self.assertIn("error", result)
+
+    def test_missingFile(self):
+        status, _ = self.client.request("POST", "/score", "{}",
+                                        {"Content-Type": "application/json"})
+        self.assertEqual(status, 400)
+
+    def test_codedNotFound(self):
+        self.scorer.references["synthetic"] = "/nonexistant.nut"
+        for coded in ["/nonexistant.nut", "lavfi:testsrc", "-f lavfi -i testsrc"]:
+            status, result = self.client.score("synthetic", coded)
+            self.assertEqual(status, 400)
+            self.assertIn("not found", result["error"])
+
+    def test_jsonCharset(self):
+        status, _ = self.client.request("POST", "/score", '{"path": "/nonexistant.nut"}',
+                                        {"Content-Type": "application/json; charset=utf-8"})
+        self.assertEqual(status, 400)
+
+        status, _ = self.client.request(
+            "POST", "/score", '{"reference": "nonexistant", "path": "/nonexistant.nut"}',
+            {"Content-Type": "application/json; charset=utf-8"})
+        self.assertEqual(status, 404)
+
+    def test_invalidLength(self):
+        for length in ["abc", "-1"]:
+            status, _ = self.client.request("POST", "/score", None, {"Content-Length": length})
+            self.assertEqual(status, 400)
+
+    def test_invalidFlags(self):
+        self.scorer.references["synthetic"] = "/nonexistant.nut"
+        body = json.dumps({"reference": "synthetic", "path": __file__, "upscale": "false"})
+        status, result = self.client.request("POST", "/score", body,
+                                             {"Content-Type": "application/json"})
+        self.assertEqual(status, 400)
+        self.assertIn("upscale", result["error"])
+
+    def test_existingFile(self):
+        filename = path.join(self.tmpdir, "keep.txt")
+        with open(filename, "w") as f:
+            f.write("keep")
+
+        with self.assertRaises(FileExistsError):
+            service.create_server(f"unix:{filename}", self.scorer)
+
+        with open(filename, "r") as f:
+            self.assertEqual(f.read(), "keep")
+
+
+class TestScoring(ServiceTest):
+    def setUp(self):
+        makedirs(self.tmpdir, exist_ok=True)
+        self.reference = path.join(self.tmpdir, "synthetic.nut")
+        self.coded = path.join(self.tmpdir, "coded.nut")
+        synthetic(self.reference, "-c:v ffvhuff")
+        synthetic(self.coded, "-c:v libx264 -crf 30")
+        self.references = [self.reference]
+        super().setUp()
+
+    def test_score(self):
+        status, result = self.client.score("synthetic", self.coded, frames=True)
+        self.assertEqual(status, 200)
+        self.assertGreater(result["score_mean"], 50)
+        self.assertEqual(len(result["frames"]), 9)
+
+    def test_upload(self):
+        status, result = self.client.upload("synthetic", self.coded)
+        self.assertEqual(status, 200)
+        self.assertNotIn("frames", result)
+
+    def test_concurrent(self):
+        futures = [self.scorer.submit("synthetic", self.coded) for _ in range(6)]
+        scores = [future.result() for future in futures]
+        self.assertTrue(all(s == scores[0] for s in scores))
+
+    def test_brokenFile(self):
+        broken = path.join(self.tmpdir, "broken.nut")
+        with open(broken, "wb") as f:
+            f.write(b"broken")
+
+        good = self.scorer.submit("synthetic", self.coded)
+        bad = self.scorer.submit("synthetic", broken)
+        self.assertTrue(good.result())
+        with self.assertRaises(service.ffmpeg.ScoreFailed):
+            bad.result()
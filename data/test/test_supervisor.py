@@ -0,0 +1,60 @@
+import unittest
+import shutil
+import subprocess
+import sys
+from os import path, makedirs
+import libquality.supervisor as supervisor
+
+basedir = path.dirname(path.realpath(__file__))
+
+
+class TestSupervisor(unittest.TestCase):
+    tmpdir = path.join(basedir, "tmp/supervisor")
+
+    def test_run(self):
+        job = supervisor.run([sys.executable, "-c", "print('hello')"], deadline=10, capture=True)
+        self.assertEqual(job["output"], b"hello\n")
+        self.assertGreater(job["max_rss"], 0)
+
+    def test_failed(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            supervisor.run([sys.executable, "-c", "exit(1)"])
+
+    def test_timeout(self):
+        with self.assertRaises(supervisor.JobTimeout):
+            supervisor.run([sys.executable, "-c", "import time; time.sleep(10)"],
+                           deadline=1, retries=0)
+
+    def test_stalled(self):
+        progress = path.join(self.tmpdir, "progress")
+        with self.assertRaises(supervisor.JobStalled):
+            supervisor.run([sys.executable, "-c", "import time; time.sleep(10)"],
+                           stall=1, progress=progress, retries=0)
+
+    def test_retry(self):
+        # crashes on first attempt, succeeds on second
+        marker = path.join(self.tmpdir, "marker")
+        script = f"""
+import os, signal
+if not os.path.exists({marker!r}):
+    open({marker!r}, "w").close()
+    os.kill(os.getpid(), signal.SIGSEGV)
+"""
+        supervisor.configure(backoff=0)
+        supervisor.run([sys.executable, "-c", script], retries=1)
+
+    def test_retryDelay(self):
+        supervisor.configure(backoff=5)
+        crash = subprocess.CalledProcessError(-11, "ffmpeg")
+        self.assertEqual(supervisor.retry_delay(crash, 0, 2), 5)
+        self.assertEqual(supervisor.retry_delay(crash, 1, 2), 10)
+        self.assertIsNone(supervisor.retry_delay(crash, 2, 2))
+        self.assertIsNone(supervisor.retry_delay(subprocess.CalledProcessError(1, "ffmpeg"), 0, 2))
+
+    def setUp(self):
+        makedirs(self.tmpdir, exist_ok=True)
+        self.settings = dict(supervisor.settings)
+
+    def tearDown(self):
+        supervisor.settings.update(self.settings)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)